@@ -0,0 +1,22 @@
+"""JSON helpers that use orjson when it is installed and the standard library otherwise."""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Deserializes a JSON document from bytes or a string."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serializes obj to UTF-8 encoded JSON, indented by two spaces if requested."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode("utf-8")
@@ -0,0 +1,373 @@
+import ctypes
+import os
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple, Union
+
+import llama_cpp
+import numpy as np
+from llama_cpp import Llama, LlamaGrammar
+from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+
+# Sampling settings matching the defaults of Llama.create_chat_completion.
+REPEAT_PENALTY = 1.1
+REPEAT_LAST_N = 64
+TOP_K = 40
+TOP_P = 0.95
+MIN_P = 0.05
+
+class BatchGenerator:
+    """Generates completions for several prompts in parallel.
+
+    Each prompt is decoded as a separate sequence in the context of a single
+    ``Llama`` instance, so that prompt processing and token generation for all
+    prompts share the same ``llama_decode`` calls instead of running one
+    completion after another.
+
+    The longest token prefix shared by all prompts is evaluated only once and
+    kept in the KV cache of every sequence, where later calls with the same
+    prefix reuse it. The generator therefore assumes it is the only user of the
+    model's context.
+
+    Attributes:
+        llm: The model whose context is used for decoding.
+        n_parallel: The maximum number of prompts decoded together.
+        n_seq_ctx: The number of context positions available to each sequence.
+    """
+
+    def __init__(self, llm: Llama, n_parallel: int):
+        """Initializes the BatchGenerator.
+
+        Args:
+            llm: The model to generate with. Its context should be large enough
+                to hold ``n_parallel`` sequences.
+            n_parallel: The maximum number of prompts decoded together.
+
+        Raises:
+            ValueError: If the model does not provide a chat template, or its
+                batch size cannot hold one token for each of ``n_parallel``
+                sequences.
+        """
+        if "tokenizer.chat_template" not in llm.metadata:
+            raise ValueError("Model metadata does not contain a chat template")
+        if n_parallel > llm.n_batch:
+            raise ValueError(
+                f"Cannot decode {n_parallel} sequences together with a batch size of {llm.n_batch}"
+            )
+
+        self.llm = llm
+        self.n_parallel = n_parallel
+        self.n_seq_ctx = llm.n_ctx() // n_parallel
+
+        self._ctx = llm._ctx.ctx
+        self._model = llm._model.model
+        self._n_vocab = llm.n_vocab()
+        self._batch = llama_cpp.llama_batch_init(llm.n_batch, 0, n_parallel)
+        self._prefix: List[int] = []
+
+        self._candidates_data = np.recarray(
+            (self._n_vocab,),
+            dtype=np.dtype(
+                [("id", np.intc), ("logit", np.single), ("p", np.single)], align=True
+            ),
+        )
+        self._candidates = llama_cpp.llama_token_data_array(
+            data=self._candidates_data.ctypes.data_as(llama_cpp.llama_token_data_p),
+            size=self._n_vocab,
+            sorted=False,
+        )
+        self._token_ids = np.arange(self._n_vocab, dtype=np.intc)
+        self._newline = llm.tokenize(b"\n", add_bos=False)
+
+        self._formatter = Jinja2ChatFormatter(
+            template=llm.metadata["tokenizer.chat_template"],
+            eos_token=self._token_text(llm.token_eos()),
+            bos_token=self._token_text(llm.token_bos()),
+        )
+
+    def __enter__(self) -> "BatchGenerator":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Frees the batch buffer allocated by llama.cpp."""
+        if self._batch is not None:
+            llama_cpp.llama_batch_free(self._batch)
+            self._batch = None
+
+    def tokenize_chat_template(
+        self, messages: List[Dict[str, str]], placeholder: str
+    ) -> Tuple[List[int], str, List[int]]:
+        """Applies the model's chat template to messages and tokenizes it around a placeholder.
+
+        This lets a fixed prompt be rendered and tokenized once, leaving only
+        the text that takes the place of the placeholder to be tokenized for
+        each prompt, with ``tokenize_continuation``.
+
+        Args:
+            messages: Chat messages with ``role`` and ``content`` keys, one of
+                which contains ``placeholder`` exactly once.
+            placeholder: The string marking where variable text goes.
+
+        Returns:
+            The tokens before the placeholder, the spaces right before it, and
+            the tokens after it. The spaces are left out of the tokens before
+            the placeholder because in the whole prompt they are tokenized
+            together with the text that follows them, so they should be
+            prepended to that text. The tokens after the placeholder end with
+            the assistant generation prompt.
+
+        Raises:
+            ValueError: If the rendered prompt does not contain the placeholder
+                exactly once.
+        """
+        result = self._formatter(messages=messages)
+        parts = result.prompt.split(placeholder)
+        if len(parts) != 2:
+            raise ValueError(f"Expected the placeholder once in the prompt, found {len(parts) - 1}")
+
+        prefix, suffix = parts
+        stripped = prefix.rstrip(" ")
+        return (
+            self.llm.tokenize(
+                stripped.encode("utf-8"), add_bos=not result.added_special, special=True
+            ),
+            prefix[len(stripped) :],
+            self.tokenize_continuation(suffix, special=True),
+        )
+
+    def tokenize_continuation(self, text: str, special: bool = False) -> List[int]:
+        """Tokenizes text as it is tokenized when it follows other text in a prompt.
+
+        SentencePiece vocabularies such as Phi-3's prepend a space to text
+        tokenized on its own, so the text is tokenized after a newline, which
+        does not merge with what follows it, and the newline's tokens are
+        dropped.
+
+        Args:
+            text: The text to tokenize.
+            special: Whether to parse special tokens in the text.
+
+        Returns:
+            The tokens of the text, without a BOS token.
+        """
+        tokens = self.llm.tokenize(b"\n" + text.encode("utf-8"), add_bos=False, special=special)
+        if tokens[: len(self._newline)] == self._newline:
+            return tokens[len(self._newline) :]
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=special)
+
+    def generate(
+        self,
+        prompts: Sequence[Sequence[int]],
+        grammar: Optional[LlamaGrammar] = None,
+        temperature: float = 0.0,
+    ) -> List[Union[str, ValueError]]:
+        """Generates a completion for each prompt.
+
+        Generation for a prompt stops at an end-of-generation token or when its
+        sequence runs out of context. Prompts that do not fit in the context of
+        a sequence are not decoded, and the others are decoded without them.
+
+        Args:
+            prompts: Tokenized prompts, at most ``n_parallel`` of them.
+            grammar: Grammar constraining every completion. Each sequence
+                decodes against its own copy.
+            temperature: Sampling temperature. Zero selects greedy decoding.
+                Either way, recently seen tokens are penalized, and above zero
+                candidates are narrowed by top-k, top-p and min-p first.
+
+        Returns:
+            The completion text for each prompt, in the order of ``prompts``, or
+            a ``ValueError`` for a prompt that does not fit in the context of
+            its sequence.
+
+        Raises:
+            ValueError: If there are too many prompts.
+            RuntimeError: If llama.cpp fails to decode a batch.
+        """
+        if len(prompts) > self.n_parallel:
+            raise ValueError(
+                f"Got {len(prompts)} prompts but at most {self.n_parallel} can be decoded together"
+            )
+
+        errors = {
+            i: ValueError(
+                f"Prompt of {len(prompt)} tokens exceeds the per-sequence context of {self.n_seq_ctx}"
+            )
+            for i, prompt in enumerate(prompts)
+            if len(prompt) >= self.n_seq_ctx
+        }
+        fitting = [prompt for i, prompt in enumerate(prompts) if i not in errors]
+        completions = iter(self._generate(fitting, grammar, temperature) if fitting else [])
+        return [errors[i] if i in errors else next(completions) for i in range(len(prompts))]
+
+    def _generate(
+        self,
+        prompts: Sequence[Sequence[int]],
+        grammar: Optional[LlamaGrammar],
+        temperature: float,
+    ) -> List[str]:
+        # The high-level API tracks what it believes is in the KV cache; make it
+        # re-evaluate from scratch if it is used after this.
+        self.llm.reset()
+        n_prefix = self._update_prefix(prompts)
+
+        grammars = [
+            llama_cpp.llama_grammar_copy(grammar.grammar) if grammar is not None else None
+            for _ in prompts
+        ]
+        try:
+            logits = self._prefill(prompts, n_prefix)
+            n_past = [len(prompt) for prompt in prompts]
+            outputs: List[List[int]] = [[] for _ in prompts]
+            recent: List[Deque[int]] = [
+                deque(prompt[-REPEAT_LAST_N:], maxlen=REPEAT_LAST_N) for prompt in prompts
+            ]
+            active = list(range(len(prompts)))
+            while active:
+                decoding = []
+                for seq_id in active:
+                    token = self._sample(
+                        logits[seq_id], recent[seq_id], grammars[seq_id], temperature
+                    )
+                    if llama_cpp.llama_token_is_eog(self._model, token):
+                        continue
+                    if n_past[seq_id] >= self.n_seq_ctx:
+                        continue
+                    if grammars[seq_id] is not None:
+                        llama_cpp.llama_grammar_accept_token(self._ctx, grammars[seq_id], token)
+                    outputs[seq_id].append(token)
+                    recent[seq_id].append(token)
+                    self._add(len(decoding), token, n_past[seq_id], seq_id, True)
+                    n_past[seq_id] += 1
+                    decoding.append(seq_id)
+
+                if decoding:
+                    self._decode(len(decoding))
+                    for i, seq_id in enumerate(decoding):
+                        logits[seq_id] = self._logits(i)
+                active = decoding
+        finally:
+            for seq_grammar in grammars:
+                if seq_grammar is not None:
+                    llama_cpp.llama_grammar_free(seq_grammar)
+
+        return [
+            self.llm.detokenize(tokens).decode("utf-8", errors="ignore") for tokens in outputs
+        ]
+
+    def _update_prefix(self, prompts: Sequence[Sequence[int]]) -> int:
+        """Brings the cached prefix in line with the prefix shared by prompts.
+
+        Cached tokens that the prompts still share are kept, everything after
+        them is dropped from every sequence, and the rest of the shared prefix
+        is evaluated once in sequence 0 and copied to the other sequences.
+
+        Returns:
+            The number of leading tokens of each prompt already in the KV cache.
+        """
+        shared = os.path.commonprefix([list(prompt) for prompt in prompts])
+        # Leave at least one token per prompt to be evaluated for its logits.
+        shared = shared[: min(len(prompt) for prompt in prompts) - 1]
+        n_reused = len(os.path.commonprefix([self._prefix, shared]))
+
+        llama_cpp.llama_kv_cache_seq_rm(self._ctx, -1, n_reused, -1)
+        self._prefix = shared[:n_reused]
+
+        for start in range(n_reused, len(shared), self.llm.n_batch):
+            tokens = shared[start : start + self.llm.n_batch]
+            for i, token in enumerate(tokens):
+                self._add(i, token, start + i, 0, i == len(tokens) - 1)
+            self._decode(len(tokens))
+        for seq_id in range(1, self.n_parallel):
+            llama_cpp.llama_kv_cache_seq_cp(self._ctx, 0, seq_id, n_reused, len(shared))
+        self._prefix = shared
+
+        return len(shared)
+
+    def _prefill(
+        self, prompts: Sequence[Sequence[int]], n_prefix: int
+    ) -> Dict[int, np.ndarray]:
+        """Evaluates the prompts after their cached prefix in as few batches as possible.
+
+        Returns:
+            The logits following the last token of each prompt, by sequence id.
+        """
+        logits = {}
+        pending = []
+        n_tokens = 0
+        for seq_id, prompt in enumerate(prompts):
+            for pos in range(n_prefix, len(prompt)):
+                token = prompt[pos]
+                is_last = pos == len(prompt) - 1
+                self._add(n_tokens, token, pos, seq_id, is_last)
+                if is_last:
+                    pending.append((seq_id, n_tokens))
+                n_tokens += 1
+
+                if n_tokens == self.llm.n_batch:
+                    self._decode(n_tokens)
+                    for pending_seq_id, i in pending:
+                        logits[pending_seq_id] = self._logits(i)
+                    pending = []
+                    n_tokens = 0
+
+        if n_tokens:
+            self._decode(n_tokens)
+            for pending_seq_id, i in pending:
+                logits[pending_seq_id] = self._logits(i)
+        return logits
+
+    def _add(self, i: int, token: int, pos: int, seq_id: int, want_logits: bool) -> None:
+        self._batch.token[i] = token
+        self._batch.pos[i] = pos
+        self._batch.n_seq_id[i] = 1
+        self._batch.seq_id[i][0] = seq_id
+        self._batch.logits[i] = want_logits
+
+    def _decode(self, n_tokens: int) -> None:
+        self._batch.n_tokens = n_tokens
+        return_code = llama_cpp.llama_decode(self._ctx, self._batch)
+        if return_code != 0:
+            raise RuntimeError(f"llama_decode returned {return_code}")
+
+    def _logits(self, i: int) -> np.ndarray:
+        logits = llama_cpp.llama_get_logits_ith(self._ctx, i)
+        return np.ctypeslib.as_array(logits, shape=(self._n_vocab,)).copy()
+
+    def _sample(
+        self,
+        logits: np.ndarray,
+        recent: Sequence[int],
+        grammar: Optional[llama_cpp.llama_grammar_p],
+        temperature: float,
+    ) -> int:
+        """Samples the next token the way Llama.sample does with its default settings."""
+        self._candidates_data.id[:] = self._token_ids
+        self._candidates_data.logit[:] = logits
+        self._candidates_data.p[:] = 0.0
+        self._candidates.size = self._n_vocab
+        self._candidates.sorted = False
+        candidates = ctypes.byref(self._candidates)
+
+        if recent:
+            last_tokens = (llama_cpp.llama_token * len(recent))(*recent)
+            llama_cpp.llama_sample_repetition_penalties(
+                self._ctx, candidates, last_tokens, len(recent), REPEAT_PENALTY, 0.0, 0.0
+            )
+        if grammar is not None:
+            llama_cpp.llama_sample_grammar(self._ctx, candidates, grammar)
+
+        if temperature <= 0:
+            return llama_cpp.llama_sample_token_greedy(self._ctx, candidates)
+        llama_cpp.llama_sample_top_k(self._ctx, candidates, TOP_K, 1)
+        llama_cpp.llama_sample_top_p(self._ctx, candidates, TOP_P, 1)
+        llama_cpp.llama_sample_min_p(self._ctx, candidates, MIN_P, 1)
+        llama_cpp.llama_sample_temp(self._ctx, candidates, temperature)
+        return llama_cpp.llama_sample_token(self._ctx, candidates)
+
+    def _token_text(self, token: int) -> str:
+        if token == -1:
+            return ""
+        return llama_cpp.llama_token_get_text(self._model, token).decode("utf-8")
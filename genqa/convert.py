@@ -2,18 +2,43 @@ import argparse
 import io
 import logging
 import os
-from typing import  Optional, Union
+import re
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+from typing import  List, Optional, Union
 
 import mammoth
 import markdownify
 import pymupdf
 import pymupdf4llm
-from cleantext import clean
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+_LINE_BREAKS = re.compile(r"\n+")
+_SPACES = re.compile(r"[^\S\n]+")
+
+# PDFs with fewer pages are extracted in-process; below this, starting worker
+# processes costs more than it saves.
+PARALLEL_PDF_MIN_PAGES = 64
+
+
+def _open_pdf(input_data: Union[str, bytes]) -> pymupdf.Document:
+    if isinstance(input_data, str):
+        return pymupdf.open(input_data)
+    return pymupdf.open(stream=input_data, filetype="pdf")
+
+
+def _extract_pdf_pages(input_data: Union[str, bytes], start: int, stop: int) -> List[str]:
+    """Extracts the plain text of pages ``start`` to ``stop`` (exclusive) of a PDF.
+
+    Runs in a worker process, which opens its own copy of the document.
+    """
+    with _open_pdf(input_data) as doc:
+        return [doc[i].get_text("text") for i in range(start, stop)]
+
 
 class DocToMarkdown:
     """A class to convert various document formats to Markdown.
@@ -24,10 +49,25 @@ class DocToMarkdown:
     Attributes:
         supported_formats (dict): A dictionary mapping file extensions to
             their respective conversion methods.
+        fast_pdf (bool): Whether PDFs are converted to plain text page by page
+            instead of running pymupdf4llm's layout analysis.
+        pdf_workers (int): The number of processes extracting text from the
+            pages of large PDFs in fast mode.
     """
 
-    def __init__(self):
-        """Initializes the DocToMarkdown with supported file formats."""
+    def __init__(self, fast_pdf: bool = True, pdf_workers: Optional[int] = None):
+        """Initializes the DocToMarkdown with supported file formats.
+
+        Args:
+            fast_pdf: Extract plain text from PDFs instead of Markdown. Skips
+                layout analysis and table detection, which dominate conversion
+                time for large PDFs.
+            pdf_workers: The number of processes extracting text from large
+                PDFs in fast mode. Defaults to the number of CPUs, up to 8.
+        """
+        self.fast_pdf = fast_pdf
+        self.pdf_workers = pdf_workers or min(8, os.cpu_count() or 1)
+        self._markdown_converter = markdownify.MarkdownConverter(strip=["img"])
         self.supported_formats = {
             ".docx": self._convert_docx,
             ".html": self._convert_html,
@@ -105,14 +145,25 @@ class DocToMarkdown:
             input_data: The PDF file path or content as bytes.
 
         Returns:
-            A string containing the Markdown representation of the PDF content.
+            A string containing the Markdown representation of the PDF content,
+            or its plain text with pages separated by blank lines if
+            ``fast_pdf`` is set.
         """
-        if isinstance(input_data, str):
-            doc = pymupdf.open(input_data)
-        else:
-            doc = pymupdf.open(stream=input_data, filetype="pdf")
-
-        return pymupdf4llm.to_markdown(doc)
+        with _open_pdf(input_data) as doc:
+            if not self.fast_pdf:
+                return pymupdf4llm.to_markdown(doc)
+            page_count = doc.page_count
+            if self.pdf_workers < 2 or page_count < PARALLEL_PDF_MIN_PAGES:
+                return "\n\n".join(page.get_text("text") for page in doc)
+
+        # PyMuPDF does not support concurrent use from threads, so pages are
+        # split into contiguous ranges, each extracted by a separate process.
+        bounds = [page_count * i // self.pdf_workers for i in range(self.pdf_workers + 1)]
+        with ProcessPoolExecutor(max_workers=self.pdf_workers) as executor:
+            pages = executor.map(
+                _extract_pdf_pages, repeat(input_data), bounds[:-1], bounds[1:]
+            )
+            return "\n\n".join(chain.from_iterable(pages))
 
     def _html_to_markdown(self, html_content: str) -> str:
         """Converts HTML to Markdown.
@@ -123,18 +174,38 @@ class DocToMarkdown:
         Returns:
             A string containing the Markdown representation of the HTML content.
         """
-        converter = markdownify.MarkdownConverter(strip=["img"])
-        markdown_text = converter.convert(html_content)
-        cleaned_text = clean(markdown_text, lower=False)
-        return cleaned_text
+        markdown_text = self._markdown_converter.convert(html_content)
+        return self._normalize_text(markdown_text)
+
+    def _normalize_text(self, text: str) -> str:
+        """Normalizes Unicode and whitespace in converted text.
+
+        Strips every line, collapses runs of line breaks into one, and collapses
+        other whitespace into single spaces.
+
+        Args:
+            text: The text to normalize.
+
+        Returns:
+            The normalized text.
+        """
+        text = unicodedata.normalize("NFKC", text)
+        text = "\n".join(line.strip() for line in text.splitlines())
+        text = _LINE_BREAKS.sub("\n", text)
+        return _SPACES.sub(" ", text).strip()
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert documents to Markdown.")
     parser.add_argument("input_file", help="Path to the input file.")
+    parser.add_argument(
+        "--pdf_layout",
+        action="store_true",
+        help="Convert PDFs to Markdown with layout analysis (slower).",
+    )
     args = parser.parse_args()
 
-    converter = DocToMarkdown()
+    converter = DocToMarkdown(fast_pdf=not args.pdf_layout)
     input_file = args.input_file
     file_type = os.path.splitext(input_file)[1].lower()
 
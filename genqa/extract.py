@@ -1,17 +1,38 @@
 import argparse
 import json
 import logging
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
 
 import semchunk
+from genqa._json import dumps, loads
+from genqa.batch import BatchGenerator
 from genqa.convert import DocToMarkdown
-from llama_cpp import Llama
+from llama_cpp import Llama, LlamaGrammar
 from tqdm.auto import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
+# Number of documents converted ahead of the one being processed by the model.
+CONVERSION_LOOKAHEAD = 2
+
+# Number of batches of chunks whose prompts are tokenized ahead of decoding.
+PROMPT_LOOKAHEAD = 2
+
+# Stands in for the chunk text when the prompt template is tokenized.
+CHUNK_PLACEHOLDER = "<<CHUNK>>"
+
+T = TypeVar("T")
+
+_converter: Optional[DocToMarkdown] = None
+
 
 qa_schema = {
     "type": "array",
@@ -26,19 +47,107 @@ qa_schema = {
     },
 }
 
+QA_GRAMMAR = LlamaGrammar.from_json_schema(json.dumps(qa_schema), verbose=False)
+
+
+def init_converter(fast_pdf: bool) -> None:
+    """Creates the converter reused by convert_document in a worker process.
+
+    PDFs are extracted serially: conversion already overlaps decoding, and more
+    extraction processes would compete with llama.cpp's threads for the CPUs.
+    """
+    global _converter
+    _converter = DocToMarkdown(fast_pdf=fast_pdf, pdf_workers=1)
+
+
+def convert_document(file_path: str) -> str:
+    return _converter.convert(file_path)
+
+
+def convert_ahead(
+    executor: Executor, file_paths: Iterable[str], depth: int = CONVERSION_LOOKAHEAD
+) -> Iterator[Tuple[str, "Future[str]"]]:
+    """Submits document conversions ahead of their consumption.
+
+    The first ``depth`` conversions are submitted immediately; after that, one
+    more is submitted each time a conversion is handed out, so at most ``depth``
+    converted documents wait in memory.
+    """
+    file_paths = iter(file_paths)
+    pending = deque(
+        (file_path, executor.submit(convert_document, file_path))
+        for file_path in islice(file_paths, depth)
+    )
+
+    def drain() -> Iterator[Tuple[str, "Future[str]"]]:
+        while pending:
+            file_path, conversion = pending.popleft()
+            for next_path in islice(file_paths, 1):
+                pending.append((next_path, executor.submit(convert_document, next_path)))
+            yield file_path, conversion
+
+    return drain()
+
+
+def prefetch(iterable: Iterable[T], depth: int) -> Iterator[T]:
+    """Iterates over iterable in a background thread, keeping up to depth items ready.
+
+    Exceptions raised by the iterable are re-raised in the consuming thread.
+    """
+    items: "queue.Queue[Tuple[str, Any]]" = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item: Tuple[str, Any]) -> None:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                put(("item", item))
+                if stopped.is_set():
+                    return
+        except Exception as e:
+            put(("error", e))
+        else:
+            put(("done", None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        # Lets the producer exit if the consumer stops early.
+        stopped.set()
+
 
 def token_count(llm: Llama, text: str) -> int:
     return len(llm.tokenize(text.encode("utf-8")))
 
 
-def generate_qa_pairs(
-    llm: Llama,
-    text: str,
-    max_questions: int,
-    initial_temperature: float = 0.0,
-    max_retries: int = 3,
-    temperature_increment: float = 0.1,
-) -> List[Dict[str, Any]]:
+def longest_token_chars(llm: Llama) -> int:
+    """Returns the length in characters of the longest token in the vocabulary.
+
+    semchunk uses this to bound how much of a long text it has to tokenize to
+    tell whether the text exceeds the chunk size.
+    """
+    return max(
+        len(llm.detokenize([token]).decode("utf-8", errors="ignore"))
+        for token in range(llm.n_vocab())
+    )
+
+
+def qa_messages(text: str, max_questions: int) -> List[Dict[str, str]]:
     prompt = f"""
     Generate a list of 1-{max_questions} question-answer pairs based on the following text. Adhere to these guidelines:
     1. Focus on quality over quantity.
@@ -58,100 +167,224 @@ def generate_qa_pairs(
         ...
     ]
     """
+    return [
+        {
+            "role": "system",
+            "content": "You are a helpful assistant that generates question-answer pairs from given text.",
+        },
+        {"role": "user", "content": prompt},
+    ]
 
-    temperature = initial_temperature
-    for attempt in range(max_retries):
-        try:
-            response = llm.create_chat_completion(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful assistant that generates question-answer pairs from given text.",
-                    },
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=temperature,
-                response_format={"type": "json_object", "schema": qa_schema},
-            )
 
-            output = json.loads(response["choices"][0]["message"]["content"])
-            return output
+def qa_prompt_template(
+    generator: BatchGenerator, max_questions: int
+) -> Tuple[List[int], str, List[int]]:
+    """Returns the QA prompt split around the chunk text, as from tokenize_chat_template."""
+    return generator.tokenize_chat_template(
+        qa_messages(CHUNK_PLACEHOLDER, max_questions), CHUNK_PLACEHOLDER
+    )
 
-        except Exception as e:
-            logging.error(f"Attempt {attempt + 1}: Failed to generate QA pairs: {str(e)}")
-            if attempt == max_retries - 1:
-                raise
-            temperature += temperature_increment
-            logging.info(f"Retrying with temperature {temperature}")
 
-    return None
+def build_prompts(
+    generator: BatchGenerator,
+    prompt_template: Tuple[List[int], str, List[int]],
+    texts: List[str],
+) -> List[List[int]]:
+    prefix_ids, spaces, suffix_ids = prompt_template
+    return [
+        prefix_ids + generator.tokenize_continuation(spaces + text) + suffix_ids
+        for text in texts
+    ]
 
 
-def process_chunk(
-    llm: Llama,
-    chunk: str,
-    max_questions: int,
+def generate_qa_pairs(
+    generator: BatchGenerator,
+    prompts: List[List[int]],
+    initial_temperature: float = 0.0,
+    max_retries: int = 3,
+    temperature_increment: float = 0.1,
+    fast_fail: bool = True,
+) -> List[Union[List[Dict[str, Any]], Exception]]:
+    # The grammar keeps output valid JSON, so parsing only fails when a
+    # completion is cut off at the context limit. Retrying that is optional.
+    if fast_fail:
+        max_retries = 1
+
+    results: List[Union[List[Dict[str, Any]], Exception]] = [None] * len(prompts)
+    pending = list(range(len(prompts)))
+    temperature = initial_temperature
+    for attempt in range(max_retries):
+        outputs = generator.generate(
+            [prompts[i] for i in pending], grammar=QA_GRAMMAR, temperature=temperature
+        )
+
+        failed = []
+        for i, output in zip(pending, outputs):
+            if isinstance(output, Exception):
+                # The prompt does not fit in the context; retrying cannot help.
+                logging.error(f"Failed to generate QA pairs: {str(output)}")
+                results[i] = output
+                continue
+            try:
+                results[i] = loads(output)
+            except ValueError as e:
+                logging.error(f"Attempt {attempt + 1}: Failed to generate QA pairs: {str(e)}")
+                results[i] = e
+                failed.append(i)
+
+        pending = failed
+        if not pending or attempt == max_retries - 1:
+            break
+        temperature += temperature_increment
+        logging.info(f"Retrying {len(pending)} chunks with temperature {temperature}")
+
+    return results
+
+
+def process_chunks(
+    generator: BatchGenerator,
+    chunks: List[str],
+    prompts: List[List[int]],
     temperature: float = 0.0,
-) -> Dict[str, Any]:
+    fast_fail: bool = True,
+) -> List[Dict[str, Any]]:
     try:
-        qa_pairs = generate_qa_pairs(llm, chunk, max_questions, temperature)
-        return {"chunk_text": chunk, "qa_pairs": qa_pairs if qa_pairs else []}
-    except Exception as e:
-        logging.error(f"Error processing chunk: {str(e)}")
-        return {"chunk_text": chunk, "qa_pairs": [], "error": str(e)}
+        results = generate_qa_pairs(generator, prompts, temperature, fast_fail=fast_fail)
+    except ValueError as e:
+        logging.error(f"Error processing chunks: {str(e)}")
+        return [{"chunk_text": chunk, "qa_pairs": [], "error": str(e)} for chunk in chunks]
+
+    chunk_results = []
+    for chunk, qa_pairs in zip(chunks, results):
+        if isinstance(qa_pairs, Exception):
+            chunk_results.append({"chunk_text": chunk, "qa_pairs": [], "error": str(qa_pairs)})
+        else:
+            chunk_results.append({"chunk_text": chunk, "qa_pairs": qa_pairs if qa_pairs else []})
+    return chunk_results
+
+
+def read_chunk_results(partial_file: Path) -> List[Dict[str, Any]]:
+    chunk_results = []
+    with open(partial_file, "rb") as f:
+        for line in f:
+            try:
+                chunk_results.append(loads(line))
+            except ValueError:
+                # Only the last line can be incomplete, after an interrupted run.
+                break
+    return chunk_results
+
+
+def read_progress(progress_file: Path) -> Optional[int]:
+    """Returns the number of processed chunks recorded next to an output file, if any."""
+    try:
+        return int(progress_file.read_text())
+    except (OSError, ValueError):
+        return None
 
 
 def process_file(
     file_path: str,
+    text: str,
     output_dir: Path,
-    llm: Llama,
+    generator: BatchGenerator,
     chunk_size: int,
     max_questions: int,
     temperature: float = 0.0,
     overwrite: bool = False,
+    max_token_chars: Optional[int] = None,
+    fast_fail: bool = True,
+    flush_every: int = 4,
 ) -> None:
     try:
-        converter = DocToMarkdown()
-        text = converter.convert(file_path)
         file_path = Path(file_path)
 
         if text is None:
             logging.error(f"Failed to extract text from file: {file_path}")
             return
 
-        chunker = semchunk.chunkerify(lambda t: token_count(llm, t), chunk_size)
+        chunker = semchunk.chunkerify(
+            lambda t: token_count(generator.llm, t),
+            chunk_size,
+            max_token_chars=max_token_chars,
+        )
         chunks = list(chunker(text))
 
         output_file = output_dir / f"{file_path.stem}_qa.json"
-
-        if output_file.exists() and not overwrite:
-            with open(output_file, "r", encoding="utf-8") as f:
-                result = json.load(f)
-            if len(result["chunks"]) == len(chunks):
+        partial_file = output_file.with_suffix(".jsonl")
+        progress_file = output_file.with_suffix(".progress")
+
+        chunk_results = []
+        if partial_file.exists() and not overwrite:
+            chunk_results = read_chunk_results(partial_file)
+            logging.info(f"Resuming processing for {file_path}")
+        elif output_file.exists() and not overwrite:
+            if read_progress(progress_file) == len(chunks):
+                logging.info(f"File {file_path} already processed. Skipping.")
+                return
+            with open(output_file, "rb") as f:
+                chunk_results = loads(f.read())["chunks"]
+            if len(chunk_results) == len(chunks):
                 logging.info(f"File {file_path} already processed. Skipping.")
                 return
             else:
                 logging.info(f"Resuming processing for {file_path}")
-        else:
-            result = {
-                "source_filepath": str(file_path),
-                "markdown_text": text,
-                "chunks": [],
-            }
 
-        with tqdm(
+        # Rewriting the log up front also drops a line left incomplete by an
+        # interrupted run, so new results are appended to a clean file.
+        with open(partial_file, "wb") as partial, tqdm(
             total=len(chunks), desc=f"Processing {file_path.name}", position=0, leave=True
         ) as pbar:
-            pbar.update(len(result["chunks"]))
-            for i, chunk in enumerate(chunks[len(result["chunks"]) :], start=len(result["chunks"])):
-                chunk_result = process_chunk(llm, chunk, max_questions, temperature)
-                result["chunks"].append(chunk_result)
+            for chunk_result in chunk_results:
+                partial.write(dumps(chunk_result) + b"\n")
+            pbar.update(len(chunk_results))
 
-                # Write intermediate results after each chunk
-                with open(output_file, "w", encoding="utf-8") as f:
-                    json.dump(result, f, indent=2)
+            windows = (
+                chunks[start : start + generator.n_parallel]
+                for start in range(len(chunk_results), len(chunks), generator.n_parallel)
+            )
+            # Prompts for the next batches are tokenized while the current one
+            # decodes; llama.cpp releases the GIL during decoding.
+            prompt_template = qa_prompt_template(generator, max_questions)
+            prompted_windows = prefetch(
+                (
+                    (window, build_prompts(generator, prompt_template, window))
+                    for window in windows
+                ),
+                PROMPT_LOOKAHEAD,
+            )
 
-                pbar.update(1)
+            def flush(unflushed: List[Dict[str, Any]]) -> None:
+                partial.write(b"".join(dumps(chunk_result) + b"\n" for chunk_result in unflushed))
+                partial.flush()
+                progress_file.write_text(str(len(chunk_results)))
+                pbar.update(len(unflushed))
+
+            # Intermediate results are appended once flush_every chunks have
+            # been processed since the last write, checked after each batch of
+            # chunks; an interrupted run only repeats the chunks since then.
+            unflushed = []
+            for window, prompts in prompted_windows:
+                window_results = process_chunks(
+                    generator, window, prompts, temperature, fast_fail=fast_fail
+                )
+                chunk_results.extend(window_results)
+                unflushed.extend(window_results)
+                if len(unflushed) >= flush_every:
+                    flush(unflushed)
+                    unflushed = []
+            if unflushed:
+                flush(unflushed)
+
+        result = {
+            "source_filepath": str(file_path),
+            "markdown_text": text,
+            "chunks": chunk_results,
+        }
+        with open(output_file, "wb") as f:
+            f.write(dumps(result, indent=True))
+        progress_file.write_text(str(len(chunk_results)))
+        partial_file.unlink()
 
         logging.info(f"Completed processing file: {file_path}")
         logging.info(f"Results written to {output_file}")
@@ -168,9 +401,22 @@ def main():
         help="Files to process",
     )
     parser.add_argument("--output_dir", default="qa_result", help="Output directory for results")
+    parser.add_argument(
+        "--model_repo",
+        default="bartowski/Phi-3.1-mini-128k-instruct-GGUF",
+        help="Hugging Face repository to download the GGUF model from",
+    )
+    parser.add_argument(
+        "--model_file",
+        default="*Q4_K_M.gguf",
+        help="Filename or glob of the GGUF file in the model repository, which selects the quantization",
+    )
     parser.add_argument("--temperature", type=float, default=0.0, help="Temperature for the model")
     parser.add_argument(
-        "--n_ctx", type=int, default=16384, help="Maximum context length for the model"
+        "--n_ctx",
+        type=int,
+        default=16384,
+        help="Maximum context length for the model, shared by the chunks decoded in parallel",
     )
     parser.add_argument("--chunk_size", type=int, default=4096, help="Maximum size of text chunks")
     parser.add_argument(
@@ -179,33 +425,117 @@ def main():
         default=3,
         help="Maximum number of questions per chunk",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=2,
+        help="Number of chunks decoded in parallel",
+    )
+    parser.add_argument(
+        "--n_batch",
+        type=int,
+        default=2048,
+        help="Maximum number of tokens llama.cpp evaluates in one batch",
+    )
+    parser.add_argument(
+        "--n_threads",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of threads used for generation (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--n_threads_batch",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of threads used for prompt processing (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--no_mmap",
+        action="store_true",
+        help="Load the model into memory instead of memory-mapping it",
+    )
+    parser.add_argument(
+        "--pdf_layout",
+        action="store_true",
+        help="Convert PDFs to Markdown with layout analysis (slower)",
+    )
+    parser.add_argument(
+        "--retry_invalid",
+        action="store_true",
+        help="Retry chunks whose output is not valid JSON with a higher temperature",
+    )
+    parser.add_argument(
+        "--flush_every",
+        type=int,
+        default=4,
+        help=(
+            "Number of chunks processed between writes of intermediate results, "
+            "rounded up to a multiple of --batch_size"
+        ),
+    )
     parser.add_argument(
         "--overwrite",
         action="store_true",
         help="Overwrite existing output files",
     )
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch_size must be at least 1")
+    if args.n_ctx // args.batch_size <= args.chunk_size:
+        parser.error(
+            "--n_ctx must leave each of the --batch_size sequences room for "
+            "--chunk_size tokens and the output"
+        )
+    if args.n_batch < args.batch_size:
+        parser.error("--n_batch must be at least --batch_size")
+    if args.flush_every < 1:
+        parser.error("--flush_every must be at least 1")
+
+    # Conversions start before the model loads and then run in a separate
+    # process, so the model never waits for document parsing.
+    executor = ProcessPoolExecutor(
+        max_workers=1, initializer=init_converter, initargs=(not args.pdf_layout,)
+    )
+    conversions = convert_ahead(executor, args.input)
 
     llm = Llama.from_pretrained(
-        repo_id="bartowski/Phi-3.1-mini-128k-instruct-GGUF",
-        filename="*Q4_K_M.gguf",
+        repo_id=args.model_repo,
+        filename=args.model_file,
         n_ctx=args.n_ctx,
+        n_batch=args.n_batch,
+        n_threads=args.n_threads,
+        n_threads_batch=args.n_threads_batch,
+        use_mmap=not args.no_mmap,
         verbose=False,
     )
 
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    with logging_redirect_tqdm():
-        for file_path in tqdm(args.input, desc="Processing files", position=0, leave=True):
+    max_token_chars = longest_token_chars(llm)
+
+    with executor, BatchGenerator(llm, args.batch_size) as generator, logging_redirect_tqdm():
+        for file_path, conversion in tqdm(
+            conversions, total=len(args.input), desc="Processing files", position=0, leave=True
+        ):
+            try:
+                text = conversion.result()
+            except Exception as e:
+                logging.error(f"Error converting file {file_path}: {str(e)}")
+                continue
+
             process_file(
                 file_path,
+                text,
                 output_dir,
-                llm,
+                generator,
                 args.chunk_size,
                 args.max_questions,
                 temperature=args.temperature,
                 overwrite=args.overwrite,
+                max_token_chars=max_token_chars,
+                fast_fail=not args.retry_invalid,
+                flush_every=args.flush_every,
             )
 
 
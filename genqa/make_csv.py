@@ -1,35 +1,52 @@
 import argparse
 import csv
-import json
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Any, Iterator
+from typing import Any, Iterator, List, Optional, Tuple
 from tqdm import tqdm
 
-def process_qa_file(file_path: Path) -> Iterator[Dict[str, Any]]:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+from genqa._json import loads
+
+FIELDNAMES = ('file_path', 'chunk_number', 'qa_number', 'question', 'answer', 'supporting_quotes')
+
+# Number of rows buffered before they are handed to csv_writer.writerows.
+WRITE_BATCH_SIZE = 10000
+
+def process_qa_file(file_path: Path) -> Iterator[Tuple[Any, ...]]:
+    with open(file_path, 'rb') as f:
+        data = loads(f.read())
     
     for chunk_number, chunk in enumerate(data['chunks'], start=1):
         for qa_number, qa_pair in enumerate(chunk['qa_pairs'], start=1):
-            yield {
-                'file_path': data['source_filepath'],
-                'chunk_number': chunk_number,
-                'qa_number': qa_number,
-                'question': qa_pair['question'],
-                'answer': qa_pair['answer'],
-                'supporting_quotes': ' | '.join(qa_pair['supporting_quotes'])
-            }
-
-def process_directory(input_dir: Path, csv_writer: csv.DictWriter):
+            yield (
+                data['source_filepath'],
+                chunk_number,
+                qa_number,
+                qa_pair['question'],
+                qa_pair['answer'],
+                ' | '.join(qa_pair['supporting_quotes']),
+            )
+
+def read_qa_rows(file_path: Path) -> List[Tuple[Any, ...]]:
+    return list(process_qa_file(file_path))
+
+def process_directory(input_dir: Path, csv_writer: Any, max_workers: Optional[int] = None):
     json_files = list(input_dir.glob('*_qa.json'))
-    for file in tqdm(json_files, desc="Processing files"):
-        for row in process_qa_file(file):
-            csv_writer.writerow(row)
+    batch: List[Tuple[Any, ...]] = []
+    # Files are parsed in worker processes; rows are written here, in file order.
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for rows in tqdm(executor.map(read_qa_rows, json_files), total=len(json_files), desc="Processing files"):
+            batch.extend(rows)
+            if len(batch) >= WRITE_BATCH_SIZE:
+                csv_writer.writerows(batch)
+                batch = []
+    csv_writer.writerows(batch)
 
 def main():
     parser = argparse.ArgumentParser(description="Convert QA JSON outputs to CSV")
     parser.add_argument("input_dir", help="Directory containing QA JSON files")
     parser.add_argument("output_file", help="Path to the output CSV file")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes parsing JSON files (default: number of CPUs)")
     args = parser.parse_args()
 
     input_dir = Path(args.input_dir)
@@ -38,12 +55,10 @@ def main():
     if not input_dir.is_dir():
         raise ValueError(f"Input directory does not exist: {input_dir}")
 
-    fieldnames = ['file_path', 'chunk_number', 'qa_number', 'question', 'answer', 'supporting_quotes']
-    
     with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        process_directory(input_dir, writer)
+        writer = csv.writer(csvfile)
+        writer.writerow(FIELDNAMES)
+        process_directory(input_dir, writer, max_workers=args.workers)
 
     print(f"CSV file has been created: {output_file}")
 